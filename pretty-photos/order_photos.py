@@ -1,193 +1,350 @@
+import calendar
 import datetime as dt
+import functools
+import logging
+import os
 import random
+import re
+import subprocess
+import time as tm
 import typing as _t
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import ffmpeg
 from PIL import Image
 
+from utils import COPY_MODES
 from utils import copy_file
 from utils import get_console_logger
-from utils import get_extension_from_path
+from utils import is_exif_date_time
+from utils import read_exif_date_time_original
+from utils import read_json
+from utils import read_quicktime_creation_time
 from utils import try_mkdir
+from utils import write_json
 
 
 # Files with different extension will be skipped
-_PHOTO_EXTENSIONS = ['JPG', 'jpg', 'JPEG', 'jpeg', 'PNG', 'png']
-_VIDEO_EXTENSIONS = ['MOV', 'mov']
+_PHOTO_EXTENSIONS = frozenset(['JPG', 'jpg', 'JPEG', 'jpeg', 'PNG', 'png'])
+_VIDEO_EXTENSIONS = frozenset(['MOV', 'mov'])
 
 # If change FILE_TIME_FMT, then also change DATE_SPLIT_CHAR and DATE_TIME_SPLIT_CHAR
 _FILE_TIME_FMT = '%Y-%m-%d_%H:%M:%S'
 _DATE_SPLIT_CHAR = _FILE_TIME_FMT.split('%Y')[1].split('%m')[0]
 _DATE_TIME_SPLIT_CHAR = _FILE_TIME_FMT.split('%Y-%m-%d')[1].split('%H:%M:%S')[0]
+_EXIF_DATE_TRANSLATION = str.maketrans({':': _DATE_SPLIT_CHAR})
+# ISO-like times are parsed much faster, datetime.fromisoformat accepts any single char between date and time
+_IS_ISO_FILE_TIME_FMT = len(_DATE_TIME_SPLIT_CHAR) == 1 and _FILE_TIME_FMT == f'%Y-%m-%d{_DATE_TIME_SPLIT_CHAR}%H:%M:%S'
 
 # Common prefix is used for interpolation, only photos that begin with COMMON_PREFIX can be interpolated
 _COMMON_INTERPOLATION_PREFIX = 'IMG_'
 _INTERPOLATED_SUFFIX = '_interpolated_time'
+_INTERPOLATION_NAME_RE = re.compile(re.escape(_COMMON_INTERPOLATION_PREFIX) + r'(\d+)$')
 
 # Whether to split output files into separate directories
 _SPLIT_INTO_YEARS = True
 
+# File with parsed times of photos from previous runs
+_CACHE_FILE_NAME = '.pretty-photos-cache.json'
+
+# Number of threads that read photo and video metadata
+_NUM_WORKERS = 2 * (os.cpu_count() or 1)
+# Number of threads that copy photos
+_NUM_COPY_WORKERS = 16
+
 _LOGGER = get_console_logger('pretty-photos')
 
+# Path, extension and creation time of photo, which is None if unknown
+PhotoTime = _t.Tuple[Path, str, _t.Optional[str]]
+
 
 def get_photo_creation_time(path: Path) -> str:
     """Extract creation time from photo properties"""
-    return Image.open(path)._getexif()[36867]
+    try:
+        return read_exif_date_time_original(path)
+    except ValueError:
+        # Not a JPEG (f.e PNG) or unusual EXIF layout, let PIL deal with it
+        photo_time = Image.open(path)._getexif()[36867]
+
+    if not is_exif_date_time(photo_time):
+        raise KeyError(f'Unexpected [DateTimeOriginal={photo_time}] in [file={path}]')
+    return photo_time
 
 
 def get_video_creation_time(path: Path) -> str:
     """Extract creation time from video properties"""
-    video_streams = ffmpeg.probe(path)['streams']
-    video_tags = video_streams[0]['tags']
-    return video_tags['creation_time'][:19]
-
-
-def parse_photo_times(input_dir: Path) -> _t.Dict[Path, str]:
-    num_dates_found = 0
-    num_dates_missing = 0
-    photo_times = {}
-    for photo_path in input_dir.iterdir():
-
-        if not photo_path.is_file():
-            _LOGGER.warning(f'Skip [path={photo_path}] since not a file ...')
-            continue
-
-        photo_ext = get_extension_from_path(photo_path)
-
-        if photo_ext in _PHOTO_EXTENSIONS:
-            try:
-                photo_time = get_photo_creation_time(photo_path)
-                photo_time = photo_time[:10].replace(':', _DATE_SPLIT_CHAR) + photo_time[10:]
-                photo_time = photo_time.replace(' ', _DATE_TIME_SPLIT_CHAR)
+    try:
+        return read_quicktime_creation_time(path)
+    except ValueError:
+        # Unusual atom layout, let ffprobe deal with it
+        pass
+
+    # Ask only for the needed tag instead of full format and streams description
+    ffprobe_cmd = [
+        'ffprobe',
+        '-v',
+        'error',
+        '-select_streams',
+        'v:0',
+        '-show_entries',
+        'stream_tags=creation_time',
+        '-of',
+        'default=noprint_wrappers=1:nokey=1',
+        str(path),
+    ]
+    creation_time = subprocess.run(ffprobe_cmd, capture_output=True, text=True, check=True).stdout.strip()
+    if not creation_time:
+        raise KeyError(f'Not found creation time in [file={path}]')
+    return creation_time[:19]
+
+
+def parse_photo_time(photo_path: Path) -> _t.Optional[PhotoTime]:
+    """Parse creation time of single photo or video, returns None if file is skipped"""
+    photo_ext = photo_path.suffix[1:]
+
+    if photo_ext in _PHOTO_EXTENSIONS:
+        try:
+            photo_time = get_photo_creation_time(photo_path)
+            # EXIF time looks like YYYY:MM:DD HH:MM:SS, only date colons are replaced
+            photo_time = photo_time[:10].translate(_EXIF_DATE_TRANSLATION) + _DATE_TIME_SPLIT_CHAR + photo_time[11:]
+
+        except (KeyError, TypeError):
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(f'PARSE: Missing time for [photo={photo_path}]')
+            return photo_path, photo_ext, None
+
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug(f'PARSE: Found [time={photo_time}] for [photo={photo_path}]')
+        return photo_path, photo_ext, photo_time
+
+    # Order videos as well
+    if photo_ext in _VIDEO_EXTENSIONS:
+        video_time = get_video_creation_time(photo_path)
+        video_time = video_time.replace('T', _DATE_TIME_SPLIT_CHAR)
+        # Treat video as photo from now on
+        return photo_path, photo_ext, video_time
+
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(f'PARSE: Could not process photo with [extension={photo_ext}]')
+    return None
+
+
+def parse_cached_photo_time(photo_entry: os.DirEntry, photo_times_cache: _t.Dict[str, list]) -> _t.Optional[PhotoTime]:
+    """Parse creation time of single photo or video, unless it is cached and file did not change since"""
+    photo_path = Path(photo_entry.path)
+    photo_stat = photo_entry.stat()
+    cached_time = photo_times_cache.get(os.path.abspath(photo_path))
+    # Cache file could be edited by hand or written by older version, so trust only entries of expected shape
+    if (
+        isinstance(cached_time, list)
+        and len(cached_time) == 3
+        and cached_time[:2] == [photo_stat.st_mtime_ns, photo_stat.st_size]
+        and (cached_time[2] is None or is_valid_file_time(cached_time[2]))
+    ):
+        return photo_path, photo_path.suffix[1:], cached_time[2]
+
+    return parse_photo_time(photo_path)
+
+
+def parse_photo_times(input_dir: Path, photo_times_cache: _t.Optional[_t.Dict[str, list]] = None) -> _t.List[PhotoTime]:
+    """Parse creation times of photos and videos, cache maps absolute path to [mtime_ns, size, time]"""
+    if photo_times_cache is None:
+        photo_times_cache = {}
+
+    photo_entries = []
+    with os.scandir(input_dir) as dir_entries:
+        for dir_entry in dir_entries:
+            # File type comes from directory listing, stat is only needed to follow symlinks
+            if not dir_entry.is_file():
+                _LOGGER.warning(f'Skip [path={dir_entry.path}] since not a file ...')
+                continue
+            photo_entries.append(dir_entry)
+
+    # Reading files in inode order reduces disk seeks on HDDs
+    photo_entries.sort(key=lambda photo_entry: photo_entry.inode())
+
+    # Reading metadata is I/O bound (and spawns ffprobe for videos), so overlap it in threads
+    with ThreadPoolExecutor(max_workers=_NUM_WORKERS) as executor:
+        parsed_times = executor.map(
+            functools.partial(parse_cached_photo_time, photo_times_cache=photo_times_cache), photo_entries
+        )
+
+        num_dates_found = 0
+        num_dates_missing = 0
+        photo_times = []
+        for photo_entry, parsed_time in zip(photo_entries, parsed_times):
+            if parsed_time is None:
+                continue
 
-            except (KeyError, TypeError):
+            photo_path, photo_ext, photo_time = parsed_time
+            if photo_time is not None and not is_valid_file_time(photo_time):
+                # Garbage time would break naming of output photos, so treat it as missing and do not cache it
+                _LOGGER.warning(f'PARSE: Ignore unexpected [time={photo_time}] of [photo={photo_path}]')
                 photo_time = None
+                parsed_time = photo_path, photo_ext, photo_time
+            else:
+                # Stat is already cached by DirEntry
+                photo_stat = photo_entry.stat()
+                photo_times_cache[os.path.abspath(photo_path)] = [
+                    photo_stat.st_mtime_ns,
+                    photo_stat.st_size,
+                    photo_time,
+                ]
+
+            if photo_time is None:
                 num_dates_missing += 1
-                _LOGGER.info(f'PARSE: Found [time={photo_time}] for [photo={photo_path}]')
-
             else:
                 num_dates_found += 1
-                _LOGGER.info(f'PARSE: Missing time for [photo={photo_path}]')
-
-        # Order videos as well
-        elif photo_ext in _VIDEO_EXTENSIONS:
-            video_time = get_video_creation_time(photo_path)
-            video_time = video_time.replace('T', _DATE_TIME_SPLIT_CHAR)
-            # Treat video as photo from now on
-            photo_time = video_time
-
-        else:
-            _LOGGER.info(f'PARSE: Could not process photo with [extension={photo_ext}]')
-            continue
-
-        photo_times[photo_path] = photo_time
+            photo_times.append(parsed_time)
 
     _LOGGER.info(f'FOUND dates: {num_dates_found} MISSING dates: {num_dates_missing}\n')
 
     return photo_times
 
 
+@functools.lru_cache(maxsize=None)
+def get_interpolation_number(photo_path: Path) -> _t.Optional[int]:
+    """Get number from photo name used for interpolation, f.e 1433 for IMG_1433"""
+    name_match = _INTERPOLATION_NAME_RE.match(photo_path.stem)
+    if name_match is None:
+        return None
+    return int(name_match.group(1))
+
+
 def is_valid_for_interpolation(photo_path: Path) -> bool:
     """Only photos with specific names are valid for interpolation"""
+    return get_interpolation_number(photo_path) is not None
+
+
+def get_interpolation_order(photo_time: PhotoTime) -> _t.Tuple[int, str]:
+    """Sort key that orders photos by number in their name, so IMG_9999 goes before IMG_10000"""
+    photo_path = photo_time[0]
+    photo_number = get_interpolation_number(photo_path)
+    return -1 if photo_number is None else photo_number, photo_path.name
+
+
+def parse_time(time: str) -> dt.datetime:
+    if _IS_ISO_FILE_TIME_FMT:
+        return dt.datetime.fromisoformat(time)
+    return dt.datetime.strptime(time, _FILE_TIME_FMT)
+
+
+def is_valid_file_time(time: _t.Any) -> bool:
+    """Check that time is formatted with FILE_TIME_FMT"""
+    if not isinstance(time, str):
+        return False
     try:
-        int(photo_path.stem.split(_COMMON_INTERPOLATION_PREFIX)[1].split('.')[0])
-    except (IndexError, ValueError, TypeError):
+        return parse_time(time).strftime(_FILE_TIME_FMT) == time
+    except ValueError:
         return False
-    return True
 
 
 def get_random_time_between(min_time: str, max_time: str) -> str:
     """Get random time between boundaries"""
-    _LOGGER.info(f'Get random time between [min_time={min_time}] and [max_time={max_time}] ...')
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(f'Get random time between [min_time={min_time}] and [max_time={max_time}] ...')
     # Add and subtract one second, so not to duplicate times
-    min_ts = int(dt.datetime.strptime(min_time, _FILE_TIME_FMT).timestamp()) + 1
-    max_ts = int(dt.datetime.strptime(max_time, _FILE_TIME_FMT).timestamp()) - 1
+    # Times are naive, treat them as UTC both ways, so local timezone does not shift output
+    min_ts = calendar.timegm(parse_time(min_time).timetuple()) + 1
+    max_ts = calendar.timegm(parse_time(max_time).timetuple()) - 1
     if max_ts < min_ts:
         raise ValueError(f'Could not get time between [min_time={min_time}] and [max_time={max_time}]')
-    time_between = dt.datetime.utcfromtimestamp(random.randint(min_ts + 1, max_ts - 1))
-    return time_between.strftime(_FILE_TIME_FMT)
+    return tm.strftime(_FILE_TIME_FMT, tm.gmtime(random.randint(min_ts + 1, max_ts - 1)))
 
 
 def get_year_from_time(time: str) -> int:
-    return dt.datetime.strptime(time, _FILE_TIME_FMT).year
+    if _IS_ISO_FILE_TIME_FMT:
+        # Year is always in front, so no need to parse whole time
+        return int(time[:4])
+    return parse_time(time).year
 
 
+@functools.lru_cache(maxsize=None)
 def try_remove_interpolated_suffix(time: str) -> str:
     if not time.endswith(_INTERPOLATED_SUFFIX):
         return time
-    return time.split(_INTERPOLATED_SUFFIX)[0]
+    return time[: -len(_INTERPOLATED_SUFFIX)]
 
 
-def interpolate_photo_times(photo_times: _t.Dict[Path, str]) -> _t.Dict[Path, str]:
-    """Interpolate missing photo time based on photo order, f.e IMG_1433"""
+@functools.lru_cache(maxsize=None)
+def get_photo_year(photo_time: str) -> int:
+    """Get year of photo time that can be interpolated, cached since many photos share times"""
+    return get_year_from_time(try_remove_interpolated_suffix(photo_time))
 
-    sorted_photos = sorted(photo_times.keys())
 
+def interpolate_photo_times(photo_times: _t.List[PhotoTime]) -> _t.List[PhotoTime]:
+    """Interpolate missing photo time based on photo order, f.e IMG_1433"""
+
+    sorted_photos = sorted(photo_times, key=get_interpolation_order)
+    # Parallel lists aligned by photo order, so passes below only index into them
+    photo_paths = [photo_path for photo_path, _, _ in sorted_photos]
+    photo_exts = [photo_ext for _, photo_ext, _ in sorted_photos]
+    sorted_times = [photo_time for _, _, photo_time in sorted_photos]
+    # Validity is checked for every photo once, neighbor search only reads it
+    valid_photos = [is_valid_for_interpolation(photo_path) for photo_path in photo_paths]
+
+    # Nearest next times are collected in a single backward pass
+    next_times = [None] * len(sorted_times)
+    next_time = None
+    for photo_ind in reversed(range(len(sorted_times))):
+        next_times[photo_ind] = next_time
+        photo_time = sorted_times[photo_ind]
+        if valid_photos[photo_ind] and photo_time is not None:
+            next_time = photo_time
+
+    # Nearest previous time is tracked while going forward, it includes already interpolated times
+    prev_time = None
     num_interpolated = 0
     num_failed = 0
-    for photo_ind, photo_path in enumerate(sorted_photos):
-        photo_time = photo_times[photo_path]
-
+    for photo_ind, photo_time in enumerate(sorted_times):
         if photo_time is not None:
+            if valid_photos[photo_ind]:
+                prev_time = photo_time
             continue
 
-        if not is_valid_for_interpolation(photo_path):
-            _LOGGER.info(f'INTERPOLATE: Skip not valid for interpolation [photo={photo_path}]')
-            continue
-
-        # Find nearest previous neighbor
-        prev_time = None
-        for prev_photo in reversed(sorted_photos[:photo_ind]):
-            if not is_valid_for_interpolation(prev_photo):
-                continue
+        photo_path = photo_paths[photo_ind]
 
-            prev_time = photo_times[prev_photo]
-            if prev_time is not None:
-                break
+        if not valid_photos[photo_ind]:
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(f'INTERPOLATE: Skip not valid for interpolation [photo={photo_path}]')
+            continue
 
         if prev_time is None:
-            _LOGGER.info(f'INTERPOLATE: Could not find previous time for [photo={photo_path}]')
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(f'INTERPOLATE: Could not find previous time for [photo={photo_path}]')
             num_failed += 1
             continue
 
-        # Find nearest next neighbor
-        next_time = None
-        for next_photo in sorted_photos[photo_ind:][1:]:
-            if not is_valid_for_interpolation(next_photo):
-                continue
-
-            next_time = photo_times[next_photo]
-            if next_time is not None:
-                break
-
+        next_time = next_times[photo_ind]
         if next_time is None:
-            _LOGGER.info(f'INTERPOLATE: Could not find next time for [photo={photo_path}]')
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(f'INTERPOLATE: Could not find next time for [photo={photo_path}]')
             num_failed += 1
             continue
 
-        # Previous time can already be interpolated
-        prev_time = try_remove_interpolated_suffix(prev_time)
-
         try:
             # NOTE: Sleeping time is possible output :)
-            photo_time = get_random_time_between(prev_time, next_time)
+            # Previous time can already be interpolated
+            photo_time = get_random_time_between(try_remove_interpolated_suffix(prev_time), next_time)
         except ValueError:
-            _LOGGER.info(f'INTERPOLATE: Could not find time for [photo={photo_path}]')
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(f'INTERPOLATE: Could not find time for [photo={photo_path}]')
             num_failed += 1
             continue
 
-        photo_times[photo_path] = photo_time + _INTERPOLATED_SUFFIX
+        prev_time = photo_time + _INTERPOLATED_SUFFIX
+        sorted_times[photo_ind] = prev_time
         num_interpolated += 1
-        _LOGGER.info(f'INTERPOLATE: Set [time={photo_time}] for [photo={photo_path}]')
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug(f'INTERPOLATE: Set [time={photo_time}] for [photo={photo_path}]')
 
     _LOGGER.info(f'INTERPOLATED times: {num_interpolated} FAILED times: {num_failed}\n')
 
-    return photo_times
+    return list(zip(photo_paths, photo_exts, sorted_times))
 
 
-def save_photos_with_times(photo_times: _t.Dict[Path, str], output_dir: Path) -> None:
+def save_photos_with_times(photo_times: _t.List[PhotoTime], output_dir: Path, copy_mode: str = 'reflink') -> None:
     """Save photos with different names that include their time into separate directory"""
 
     photos_dir_with_times = try_mkdir(output_dir)
@@ -197,34 +354,59 @@ def save_photos_with_times(photo_times: _t.Dict[Path, str], output_dir: Path) ->
     _LOGGER.info(f'Will save photos without time into [directory={photos_dir_without_times}]')
     _LOGGER.info('...')
 
-    for photo_path, photo_time in photo_times.items():
-        photo_ext = get_extension_from_path(photo_path)
+    if _SPLIT_INTO_YEARS:
+        # Create every year directory once, instead of once per photo
+        photo_years = {get_photo_year(photo_time) for _, _, photo_time in photo_times if photo_time is not None}
+        for photo_year in photo_years:
+            try_mkdir(photos_dir_with_times / str(photo_year))
 
+    copy_paths = []
+    output_paths = set()
+    for photo_path, photo_ext, photo_time in photo_times:
         if photo_time is not None:
-            photo_name = f'{photo_time}.{photo_ext}'
+            photo_stem = photo_time
 
-            output_path = photos_dir_with_times
+            output_dir_path = photos_dir_with_times
             if _SPLIT_INTO_YEARS:
-                try:
-                    photo_year = get_year_from_time(try_remove_interpolated_suffix(photo_time))
-                except ValueError:
-                    raise
-                output_path = try_mkdir(output_path / str(photo_year))
-            output_path /= photo_name
+                output_dir_path /= str(get_photo_year(photo_time))
 
         else:
-            photo_name = f'{photo_path.stem}.{photo_ext}'
-            output_path = photos_dir_without_times / photo_name
+            photo_stem = photo_path.stem
+            output_dir_path = photos_dir_without_times
 
-        copy_file(photo_path, output_path)
+        # Photos taken within the same second get the same name, number them so none is lost.
+        # This also guarantees that parallel copies never write into the same file
+        output_path = output_dir_path / f'{photo_stem}.{photo_ext}'
+        duplicate_num = 0
+        while output_path in output_paths:
+            duplicate_num += 1
+            output_path = output_dir_path / f'{photo_stem}_{duplicate_num}.{photo_ext}'
+        output_paths.add(output_path)
+
+        copy_paths.append((photo_path, output_path))
+
+    # Copies are independent and I/O bound, so keep several of them in flight
+    with ThreadPoolExecutor(max_workers=_NUM_COPY_WORKERS) as executor:
+        # Consume results, so copy errors are raised
+        list(executor.map(lambda paths: copy_file(*paths, mode=copy_mode), copy_paths))
 
 
 def main() -> None:
     parser = ArgumentParser()
     parser.add_argument('--input-dir', required=True, type=str, help='Directory with input photos')
     parser.add_argument('--output-dir', required=True, type=str, help='Directory for output photos')
+    parser.add_argument(
+        '--copy-mode',
+        default='reflink',
+        choices=COPY_MODES,
+        help='How to copy photos, hardlinks share data with input photos, reflinks and copies do not',
+    )
+    parser.add_argument('--verbose', action='store_true', help='Log details about every photo')
     args = parser.parse_args()
 
+    if args.verbose:
+        _LOGGER.setLevel(logging.DEBUG)
+
     input_dir = Path(args.input_dir)
     if not input_dir.exists():
         raise FileNotFoundError(f'Not found [directory={input_dir}] with photos!')
@@ -233,9 +415,22 @@ def main() -> None:
     if output_dir.exists():
         raise FileExistsError(f'Already exists [directory={output_dir}] with photos!')
 
-    photo_times = parse_photo_times(input_dir)
+    # Cache stays next to output directory, so it survives between runs
+    cache_path = output_dir.parent / _CACHE_FILE_NAME
+    photo_times_cache = read_json(cache_path, default={})
+    if not isinstance(photo_times_cache, dict):
+        _LOGGER.warning(f'Ignore cache with unexpected format in [file={cache_path}]')
+        photo_times_cache = {}
+
+    photo_times = parse_photo_times(input_dir, photo_times_cache)
+    try:
+        write_json(photo_times_cache, try_mkdir(cache_path.parent) / _CACHE_FILE_NAME)
+    except OSError as error:
+        # Cache only speeds up next runs, so it must not abort this one
+        _LOGGER.warning(f'Could not save cache into [file={cache_path}]: {error}')
+
     photo_times = interpolate_photo_times(photo_times)
-    save_photos_with_times(photo_times, output_dir)
+    save_photos_with_times(photo_times, output_dir, copy_mode=args.copy_mode)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,73 @@
+import errno
+import json
 import logging
+import os
+import re
 import shutil
+import struct
+import sys
+import time
 import typing as _t
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, reflinks are not supported there
+    fcntl = None
+
+
+# JPEG markers and EXIF tags needed to reach DateTimeOriginal
+_JPEG_SOI_MARKER = b'\xff\xd8'
+_JPEG_APP1_MARKER = 0xE1
+_JPEG_SOS_MARKER = 0xDA
+_EXIF_HEADER = b'Exif\x00\x00'
+_EXIF_IFD_POINTER_TAG = 0x8769
+_EXIF_DATE_TIME_ORIGINAL_TAG = 0x9003
+_TIFF_BYTE_ORDERS = {b'II': '<', b'MM': '>'}
+_EXIF_DATE_TIME_RE = re.compile(r'\d{4}:\d{2}:\d{2} \d{2}:\d{2}:\d{2}$')
+
+# QuickTime atoms needed to reach movie creation time
+_QUICKTIME_MOVIE_ATOM = b'moov'
+_QUICKTIME_MOVIE_HEADER_ATOM = b'mvhd'
+# Seconds between 1904-01-01 (QuickTime epoch) and 1970-01-01 (Unix epoch)
+_QUICKTIME_EPOCH_OFFSET = 2082844800
+
+# Linux ioctl that clones file extents (reflink) on copy-on-write filesystems, f.e btrfs or XFS
+_FICLONE = 0x40049409
+# Errors meaning that reflinks will not work for any other file either
+_REFLINK_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL)
+# Same ioctl number means something else on other platforms, turned off after first unsupported error
+_is_reflink_supported = fcntl is not None and sys.platform.startswith('linux')
+
+# From the cheapest to the most expensive, each mode falls back to the next ones
+COPY_MODES = ('hardlink', 'reflink', 'copy')
+
+
+class CachedTimeFormatter(logging.Formatter):
+    """Formatter that formats record time once per second, since consecutive records mostly share it"""
+
+    def __init__(self, fmt: _t.Optional[str] = None, datefmt: _t.Optional[str] = None) -> None:
+        super().__init__(fmt, datefmt)
+        self._cached_time = (None, '')
+
+    def formatTime(self, record: logging.LogRecord, datefmt: _t.Optional[str] = None) -> str:
+        if datefmt is not None:
+            return super().formatTime(record, datefmt)
+
+        record_second = int(record.created)
+        cached_second, cached_time = self._cached_time
+        if record_second != cached_second:
+            cached_time = time.strftime(self.default_time_format, self.converter(record.created))
+            self._cached_time = (record_second, cached_time)
+        return self.default_msec_format % (cached_time, record.msecs)
+
 
 def get_console_logger(name: _t.Optional[str] = None) -> logging.Logger:
     """Get simple console logger with custom name"""
     logger = logging.getLogger(name)
     handler = logging.StreamHandler()
-    formatter = logging.Formatter("[%(asctime)s] [%(name)s] [%(levelname)s] - %(message)s")
+    formatter = CachedTimeFormatter("[%(asctime)s] [%(name)s] [%(levelname)s] - %(message)s")
     handler.setFormatter(formatter)
     logger.setLevel(logging.INFO)
     logger.addHandler(handler)
@@ -16,14 +75,181 @@ def get_console_logger(name: _t.Optional[str] = None) -> logging.Logger:
     return logger
 
 
-def get_extension_from_path(path: Path) -> str:
-    return path.suffix[1:]
-
-
 def try_mkdir(dir_path: Path) -> Path:
     dir_path.mkdir(parents=True, exist_ok=True)
     return dir_path
 
 
-def copy_file(input_path: Path, output_path: Path) -> None:
-    shutil.copy(str(input_path), str(output_path))
+def read_json(path: Path, default: _t.Any = None) -> _t.Any:
+    """Read JSON file, returns default if file does not exist or is broken"""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(data: _t.Any, path: Path) -> None:
+    with open(path, 'w') as file:
+        json.dump(data, file)
+
+
+def try_hardlink_file(input_path: Path, output_path: Path) -> bool:
+    try:
+        os.link(input_path, output_path)
+    except OSError:
+        # Different filesystems or filesystem without hardlinks
+        return False
+    return True
+
+
+def try_reflink_file(input_path: Path, output_path: Path) -> bool:
+    global _is_reflink_supported
+    if not _is_reflink_supported:
+        return False
+
+    with open(input_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
+        try:
+            fcntl.ioctl(output_file.fileno(), _FICLONE, input_file.fileno())
+        except OSError as error:
+            # Different filesystems or filesystem without copy-on-write, do not retry for every file
+            if error.errno in _REFLINK_UNSUPPORTED_ERRNOS:
+                _is_reflink_supported = False
+            return False
+    return True
+
+
+def copy_file(input_path: Path, output_path: Path, mode: str = 'reflink') -> None:
+    """Copy file with the cheapest primitive allowed by mode, see COPY_MODES"""
+    if mode not in COPY_MODES:
+        raise ValueError(f'Unknown copy [mode={mode}], expected one of {COPY_MODES}')
+
+    if mode == 'hardlink' and try_hardlink_file(input_path, output_path):
+        return
+    if mode in ('hardlink', 'reflink') and try_reflink_file(input_path, output_path):
+        return
+    # Permission bits are not copied, copyfile uses zero-copy syscalls where available
+    shutil.copyfile(input_path, output_path)
+
+
+def _read_jpeg_exif_segment(path: Path) -> bytes:
+    """Read only APP1 EXIF segment of JPEG file, skipping other segments and image data"""
+    with open(path, 'rb') as file:
+        if file.read(2) != _JPEG_SOI_MARKER:
+            raise ValueError(f'Not a JPEG [file={path}]')
+
+        while True:
+            segment_header = file.read(4)
+            if len(segment_header) < 4 or segment_header[0] != 0xFF:
+                raise ValueError(f'Broken JPEG segments in [file={path}]')
+
+            marker = segment_header[1]
+            # Image data starts after SOS, EXIF can not be located there
+            if marker == _JPEG_SOS_MARKER:
+                raise KeyError(f'Not found EXIF in [file={path}]')
+
+            segment_size = struct.unpack('>H', segment_header[2:])[0] - 2
+            if marker != _JPEG_APP1_MARKER:
+                file.seek(segment_size, 1)
+                continue
+
+            segment = file.read(segment_size)
+            if segment.startswith(_EXIF_HEADER):
+                return segment[len(_EXIF_HEADER) :]
+
+
+def _find_ifd_entry(tiff: bytes, byte_order: str, ifd_offset: int, tag: int) -> bytes:
+    """Find 12-byte entry with tag inside TIFF image file directory"""
+    (num_entries,) = struct.unpack_from(byte_order + 'H', tiff, ifd_offset)
+    for entry_offset in range(ifd_offset + 2, ifd_offset + 2 + 12 * num_entries, 12):
+        if struct.unpack_from(byte_order + 'H', tiff, entry_offset)[0] == tag:
+            return tiff[entry_offset : entry_offset + 12]
+    raise KeyError(tag)
+
+
+def is_exif_date_time(value: _t.Any) -> bool:
+    """Check that value looks like EXIF time, f.e 2020:10:27 16:39:16"""
+    return isinstance(value, str) and _EXIF_DATE_TIME_RE.match(value) is not None
+
+
+def read_exif_date_time_original(path: Path) -> str:
+    """Read EXIF DateTimeOriginal of JPEG file without decoding whole image and EXIF
+
+    Raises ValueError if file is not a valid JPEG and KeyError if it has no DateTimeOriginal
+    """
+    tiff = _read_jpeg_exif_segment(path)
+    byte_order = _TIFF_BYTE_ORDERS.get(tiff[:2])
+    if byte_order is None:
+        raise ValueError(f'Unknown TIFF byte order in [file={path}]')
+
+    try:
+        (ifd0_offset,) = struct.unpack_from(byte_order + 'I', tiff, 4)
+        exif_ifd_entry = _find_ifd_entry(tiff, byte_order, ifd0_offset, _EXIF_IFD_POINTER_TAG)
+        (exif_ifd_offset,) = struct.unpack_from(byte_order + 'I', exif_ifd_entry, 8)
+        date_time_entry = _find_ifd_entry(tiff, byte_order, exif_ifd_offset, _EXIF_DATE_TIME_ORIGINAL_TAG)
+    except struct.error as error:
+        raise ValueError(f'Broken EXIF in [file={path}]') from error
+
+    # ASCII value of 'YYYY:MM:DD HH:MM:SS\0' does not fit into entry, so entry holds its offset
+    _, _, value_size, value_offset = struct.unpack(byte_order + 'HHII', date_time_entry)
+    if value_size <= 4:
+        value = date_time_entry[8 : 8 + value_size]
+    elif value_offset + value_size <= len(tiff):
+        value = tiff[value_offset : value_offset + value_size]
+    else:
+        raise ValueError(f'DateTimeOriginal points outside of EXIF in [file={path}]')
+
+    date_time = value.rstrip(b'\x00 ').decode('ascii')
+    if not is_exif_date_time(date_time):
+        raise KeyError(f'Unexpected [DateTimeOriginal={date_time}] in [file={path}]')
+    return date_time
+
+
+def _find_quicktime_atom(file: _t.BinaryIO, atom_type: bytes, end: _t.Optional[int] = None) -> int:
+    """Seek over sibling atoms starting at current position, returns size of found atom body"""
+    while end is None or file.tell() < end:
+        atom_header = file.read(8)
+        if len(atom_header) < 8:
+            break
+
+        atom_size, found_type = struct.unpack('>I4s', atom_header)
+        header_size = 8
+        if atom_size == 1:
+            (atom_size,) = struct.unpack('>Q', file.read(8))
+            header_size = 16
+        elif atom_size == 0:
+            # Last atom, which extends to the end of file
+            if found_type != atom_type:
+                break
+            return (end if end is not None else os.fstat(file.fileno()).st_size) - file.tell()
+
+        if atom_size < header_size:
+            break
+
+        if found_type == atom_type:
+            return atom_size - header_size
+        file.seek(atom_size - header_size, 1)
+
+    raise KeyError(atom_type)
+
+
+def read_quicktime_creation_time(path: Path) -> str:
+    """Read creation time of QuickTime video from moov/mvhd atom, f.e 2020-10-27T16:39:16
+
+    Raises ValueError if creation time could not be read
+    """
+    with open(path, 'rb') as file:
+        try:
+            movie_size = _find_quicktime_atom(file, _QUICKTIME_MOVIE_ATOM)
+            _find_quicktime_atom(file, _QUICKTIME_MOVIE_HEADER_ATOM, end=file.tell() + movie_size)
+            version = file.read(4)[0]
+            time_fmt = '>Q' if version == 1 else '>I'
+            (creation_time,) = struct.unpack(time_fmt, file.read(struct.calcsize(time_fmt)))
+        except (KeyError, IndexError, struct.error) as error:
+            raise ValueError(f'Not found creation time in [file={path}]') from error
+
+    # Zero means time was never set
+    if creation_time == 0:
+        raise ValueError(f'Not set creation time in [file={path}]')
+
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(creation_time - _QUICKTIME_EPOCH_OFFSET))